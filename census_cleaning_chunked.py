@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+# Replication Script for data cleaning: "Historical Census of Monks and Nuns in Tibetan Monasteries, ca. 1642-1923"
+# Repository doi: https://doi.org/10.7910/DVN/DUGC7Z
+# Author: Rocco Bowman
+# Contact: rbowman2@ucmerced.edu
+# Article Citation: Ryavec, Karl E. and Rocco N. Bowman. 2021. "Comparing Historical Population Estimates with the
+#    Monks and Nuns: What was the Clerical Proportion?", Revue d’Etudes Tibetaines.
+
+# Chunked version of census_cleaning.py for archives of many census workbooks or transcriptions.
+# Each file is streamed in chunks of rows which are cleaned and summed by dzong as they arrive, so
+# memory is bounded by the chunk size (plus one row per dzong) instead of by the size of the archive.
+# Every file must have the same column layout as the Dataverse census sheet. Output is the same
+# CTMdata_edit.csv and datajoin.csv as census_cleaning.py.
+
+import os
+import pandas as pd
+from openpyxl import load_workbook
+
+# Change these paths to those on your local machine where the census files reside and where you want your outputs to go
+census_paths = ['Your Census File Here.xlsx', 'Another Transcription Here.csv']
+spatial_path = r'..\Data\fortress_coords.csv'
+outpath = r'..\Output'
+
+# Number of census rows held in memory at once
+chunksize = 50000
+
+# Positions of gisid, dzong, monks and nuns in the census sheet (the rest are dropped)
+census_cols = [1,2,5,6]
+
+# Some consolidation of dzong names to better match GIS data
+dzong_aliases = {
+    "Sreng dang E khul": "Nedong",
+    "U khul (Potala)": "Potala",
+    "Shigatse dang Rinchen": "Shigatse",
+    "Tsang khul dang Tod khul Rinpung khul": "Rinpung",
+    "Dakpo - Chokhorgyal": "Chokhorgyal",
+    "Dzonga / Saga": "Dzongka",
+}
+
+# Dzong making up each ecoregional grouping
+ecoregions = {
+    'Dokpo and Kongpo': ['Zhokha','Gyamda','Jomo','Tsegang','Kyimtong','Kunam','Chokhorgyal','Olkha','Lhagyari'],
+    'Lhokha': ['Dowa','Senge','Darma','Lhakhang','Tsona','Lhuntse'],
+    'Drigu': ['Drigu'],
+    'Yamdrok Yumtso': ['Nakhartse'],
+    'U': ['Nyemo','Zadam','Khartse','Chushur','Langtang','Lhundrub','Tagtse','Malgung','Potala','Samye','Gongkar',
+          'Dol','Chongye','Nedong','On'],
+    'Himalayan': ['Dzongka','Kyirong','Nyanang','Shelkar','Tingkye','Gampa','Phari','Ciblung'],
+    'Tsang': ['Shigatse','Rinpung','Lhunrab','Panam','Gyangtse','Namling','Gyatso','Lhabu','Tanak Rinchetse',
+              'Shetongmon','Puntsokling','Sakya','Lhatse','Ngamring','Lingkar','Rinchentse'],
+}
+
+columns = ["gisid","dzong","monks","nuns"]
+counts = ["monks","nuns","totalcensus"]
+
+# Stream one census file as data frames of at most chunksize rows.
+# csv transcriptions are read with pandas; Excel workbooks are read row by row in read-only mode
+# so the whole sheet is never loaded.
+
+def read_census(path):
+    if path.lower().endswith('.csv'):
+        for chunk in pd.read_csv(path, usecols=census_cols, chunksize=chunksize):
+            chunk.columns = columns
+            yield chunk
+        return
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = []
+        # Empty rows are only counted until a filled row follows, so trailing ones are dropped as read_excel does
+        # (sheets formatted down to the last Excel row return about a million of them)
+        blank = 0
+        for row in workbook.worksheets[0].iter_rows(min_row=2, values_only=True):
+            values = [row[i] if i < len(row) else None for i in census_cols]
+            if all(v is None for v in values):
+                blank += 1
+                continue
+            while blank:
+                added = min(blank, chunksize - len(rows))
+                rows.extend([None] * len(census_cols) for _ in range(added))
+                blank -= added
+                if len(rows) == chunksize:
+                    yield pd.DataFrame(rows, columns=columns)
+                    rows = []
+            rows.append(values)
+            if len(rows) == chunksize:
+                yield pd.DataFrame(rows, columns=columns)
+                rows = []
+        if rows:
+            yield pd.DataFrame(rows, columns=columns)
+    finally:
+        workbook.close()
+
+# Clean a chunk the same way census_cleaning.py cleans the whole sheet: trim and consolidate dzong names,
+# fill NA counts with zero and total the two census columns
+
+def clean_chunk(chunk):
+    chunk['gisid'] = chunk['gisid'].fillna(0)
+    chunk['dzong'] = chunk['dzong'].map(lambda name: name.strip() if isinstance(name, str) else None)
+    chunk['dzong'] = chunk['dzong'].replace(dzong_aliases).astype('category')
+    chunk['monks'] = compact_counts(chunk['monks'])
+    chunk['nuns'] = compact_counts(chunk['nuns'])
+    chunk['totalcensus'] = chunk['monks'] + chunk['nuns']
+    return chunk
+
+# Counts are stored as int32 when they are all whole numbers; fractional transcriptions (e.g. 12.5) stay floats
+
+def compact_counts(column):
+    column = pd.to_numeric(column.fillna(0))
+    if (column % 1 == 0).all():
+        return column.astype('int32')
+    return column.astype('float64')
+
+# Clean every chunk, write it out and add its counts to the running totals per dzong
+
+print('Cleaning census chunks...')
+edit_path = os.path.join(outpath, 'CTMdata_edit.csv')
+totals = None
+header = True
+
+for path in census_paths:
+    for chunk in read_census(path):
+        # A header-only csv still yields one empty chunk, which must not count as census data
+        if chunk.empty:
+            continue
+        chunk = clean_chunk(chunk)
+        chunk.to_csv(edit_path, mode='w' if header else 'a', header=header, index=False)
+        header = False
+
+        # Rows with no dzong are kept as their own group, as in census_cleaning.py
+        partial = chunk.groupby('dzong', observed=True, dropna=False)[counts].sum()
+        partial.index = partial.index.astype('object')
+        totals = partial if totals is None else totals.add(partial, fill_value=0)
+    print(path + ' done')
+
+if totals is None:
+    raise ValueError('No census rows were read from ' + ', '.join(census_paths))
+
+# Load spatial point data for the fortresses (monastery area proxy)
+
+spatial = pd.DataFrame(pd.read_csv(spatial_path))
+
+# Join census totals to spatial points by name
+
+join = pd.merge(totals.rename_axis('dzong').reset_index(), spatial[['dzong']], on='dzong', how='outer')
+
+# Providing an unique numeric id for each unique dzong name for aggregation
+join = join.sort_values(['dzong'])
+join.insert(0, 'gisid', pd.factorize(join['dzong'])[0])
+
+# Aggregate census data on dzong (one entry per unique id)
+
+agg = join.groupby('gisid', as_index=False).agg(
+    {
+         'dzong': 'first',
+         'monks': 'sum',
+         'nuns': 'sum',
+         'totalcensus': 'sum',
+    }
+)
+
+# Copy data for Shigatse to Rinchentse (looked up by name, as the row order depends on which dzong the registers hold)
+
+shigatse = agg.loc[agg['dzong'] == 'Shigatse', 'monks']
+if shigatse.empty:
+    raise ValueError('No Shigatse row to copy to Rinchentse')
+agg.loc[agg['dzong'] == 'Rinchentse', 'totalcensus'] = shigatse.iloc[0]
+
+# Make Phari "no data"
+
+agg.loc[agg['dzong'] == 'Phari', 'totalcensus'] = 0
+
+# Creating and filling a column for ecoregional grouping
+
+agg['ecoregion'] = "Not Assigned"
+
+for ecoregion, dzongs in ecoregions.items():
+    agg.loc[agg['dzong'].isin(dzongs), 'ecoregion'] = ecoregion
+
+# Remove remaining dzong with missing data
+
+agg = agg.drop(agg.index[agg.ecoregion == 'Not Assigned'])
+
+# Make Phari 0 given historical circumstances
+agg.loc[(agg['dzong'] == 'Phari'), 'monks'] = 0
+
+# Export final data for spatial join
+
+agg.to_csv(os.path.join(outpath, 'datajoin.csv'), index = False)
+
+print('Script completed!')
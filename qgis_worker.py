@@ -0,0 +1,354 @@
+# Stand-alone script run with the Python interpreter that ships with QGIS
+
+# Replication Script for data processing: "Historical Census of Monks and Nuns in Tibetan Monasteries, ca. 1642-1923"
+# Repository doi: https://doi.org/10.7910/DVN/DUGC7Z
+# Author: Rocco Bowman
+# Contact: rbowman2@ucmerced.edu
+# Article Citation: Ryavec, Karl E. and Rocco N. Bowman. 2021. "Comparing Historical Population Estimates with the
+#    Monks and Nuns: What was the Clerical Proportion?", Revue d’Etudes Tibetaines.
+
+## Overview ##
+#1 Establish working directories and worker settings
+#2 Start QGIS and load required packages
+#3 Load and index base layers once
+#4 Scenario calculation (same steps as qgis_calculation.py)
+#5 Serve scenario jobs
+
+# The worker keeps the base layers of qgis_calculation.py in memory and runs one scenario per job, so each job
+# only pays for the calculation. Jobs are sent as one line of JSON to the worker's local socket, for example
+#
+#   {"census": "C:/Output/datajoin.csv", "tract": "C:/Data/twang_tract.shp",
+#    "constants": {"yield_low": 1.3}, "output": "C:/Output/scenario1/"}
+#
+# "census" is required. "tract" defaults to twang_tract.shp, "constants" override the defaults below and
+# "output" (optional) is a folder for thiessen_final.shp and thiessen_final.csv. The worker answers with one line
+# of JSON holding the population range and cultivated hectares, or {"ok": false, "error": ...} if the job failed.
+
+###########################################################
+## 1 ## Establish working directories and worker settings ##
+###########################################################
+
+# Change these paths to those on your local machine where the initial data and QGIS reside
+inpath = 'Your Data Folder Here'
+qgis_prefix = 'Your QGIS Install Folder Here'
+plugins_path = 'Your QGIS Python Plugins Folder Here'
+
+# Local address the worker listens on
+host = '127.0.0.1'
+port = 8765
+
+# Default constants of the calculation, each of which can be overridden per job
+defaults = {
+    'buffer': 150,              # voronoi buffer (percent)
+    'barley_share': 0.70,       # share of farmland cultivated as barley
+    'yield_low': 1.5,           # metric tons of barley per hectare, low end
+    'yield_high': 2.2,          # metric tons of barley per hectare, high end
+    'yield_avg': 1.85,          # metric tons of barley per hectare, average
+    'consumption': 0.320125,    # metric tons of barley per person per year
+}
+
+#################################################
+## 2 ## Start QGIS and load required packages ##
+#################################################
+
+import json
+import os
+import queue
+import socketserver
+import sys
+import threading
+
+from qgis.core import QgsApplication, QgsFeatureRequest, QgsField, QgsVectorFileWriter, QgsVectorLayer, NULL
+from qgis.PyQt.QtCore import QUrl, QVariant
+
+print('Starting QGIS...')
+QgsApplication.setPrefixPath(qgis_prefix, True)
+qgs = QgsApplication([], False)
+qgs.initQgis()
+
+sys.path.append(plugins_path)
+import processing
+from processing.core.Processing import Processing
+Processing.initialize()
+
+##########################################
+## 3 ## Load and index base layers once ##
+##########################################
+
+# Copy a shapefile into an indexed memory layer so jobs never read it from disk again
+
+def load_layer(path):
+    layer = QgsVectorLayer(path, os.path.splitext(os.path.basename(path))[0], 'ogr')
+    if not layer.isValid():
+        raise ValueError('Could not load ' + path)
+    layer = layer.materialize(QgsFeatureRequest())
+    layer.dataProvider().createSpatialIndex()
+    return layer
+
+print('Loading base layers...')
+monastery = load_layer(inpath + 'monk_points_edit.shp')
+farm_sample = load_layer(inpath + 'farm_sample.shp')
+china_arable = load_layer(inpath + 'china_arable.shp')
+independent = load_layer(inpath + 'independent.shp')
+pop_1990 = load_layer(inpath + '1990_pop.shp')
+
+# The farmland union does not depend on the scenario, so it is built once
+
+print('Building farmland union...')
+farm_union = processing.run(
+    "native:union",
+    {'INPUT':farm_sample,
+    'OVERLAY':china_arable,
+    'OVERLAY_FIELDS_PREFIX':'',
+    'OUTPUT':'memory:'})['OUTPUT']
+farm_union.dataProvider().createSpatialIndex()
+
+# Tracts and the farmland clipped to them are kept per tract path, as most jobs share the same tract
+
+tracts = {}
+
+def load_tract(path):
+    if path not in tracts:
+        print('Loading tract ' + path + '...')
+        tract = load_layer(path)
+        farm_clip = processing.run(
+            "native:clip",
+            {'INPUT':farm_union,
+            'OVERLAY':tract,
+            'OUTPUT':'memory:'})['OUTPUT']
+        farm_clip = processing.run(
+            "native:difference",
+            {'INPUT':farm_clip,
+            'OVERLAY':independent,
+            'OUTPUT':'memory:'})['OUTPUT']
+        farm_clip.dataProvider().createSpatialIndex()
+        tracts[path] = (tract, farm_clip)
+    return tracts[path]
+
+load_tract(inpath + 'twang_tract.shp')
+
+##################################################################
+## 4 ## Scenario calculation (same steps as qgis_calculation.py) ##
+##################################################################
+
+# Attribute value with NULL as None
+
+def value(feature, name):
+    v = feature[name]
+    return None if v is None or v == NULL else v
+
+# Division that gives NULL on NULL input or division by zero, as the field calculator does
+
+def divide(a, b):
+    if a is None or b is None or b == 0:
+        return None
+    return a / b
+
+def multiply(a, b):
+    if a is None or b is None:
+        return None
+    return a * b
+
+# Add double fields to a memory layer and fill them from a function of each feature
+
+def add_fields(layer, names, calculate):
+    provider = layer.dataProvider()
+    provider.addAttributes([QgsField(name, QVariant.Double) for name in names])
+    layer.updateFields()
+    indexes = [layer.fields().indexOf(name) for name in names]
+    changes = {}
+    for feature in layer.getFeatures():
+        changes[feature.id()] = dict(zip(indexes, calculate(feature)))
+    provider.changeAttributeValues(changes)
+
+def run_scenario(job):
+    if not isinstance(job, dict):
+        raise ValueError('A job must be a JSON object, got ' + type(job).__name__)
+    if not isinstance(job.get('census'), str):
+        raise ValueError('A job needs "census", the path to a census csv')
+    if not isinstance(job.get('constants', {}), dict):
+        raise ValueError('"constants" must be a JSON object of constant names and numbers')
+    constants = dict(defaults)
+    for name, v in job.get('constants', {}).items():
+        if name not in defaults:
+            raise ValueError('Unknown constant ' + name + ' (expected one of ' + ', '.join(defaults) + ')')
+        try:
+            constants[name] = float(v)
+        except (TypeError, ValueError):
+            raise ValueError('Constant ' + name + ' is not a number: ' + repr(v))
+    tract, farm_clip = load_tract(job.get('tract', inpath + 'twang_tract.shp'))
+
+    # Join census csv to fortress points
+
+    csv = QgsVectorLayer(QUrl.fromLocalFile(job['census']).toString(), "datajoin", "delimitedtext")
+    if not csv.isValid():
+        raise ValueError('Could not load ' + job['census'])
+
+    joined = processing.run(
+        "native:joinattributestable",
+        {'INPUT':monastery,
+        'FIELD':'dzong',
+        'INPUT_2':csv,
+        'FIELD_2':'dzong',
+        'FIELDS_TO_COPY':['monks','nuns','totalcensus','ecoregion'],
+        'METHOD':1,
+        'DISCARD_NONMATCHING':False,
+        'PREFIX':'',
+        'OUTPUT':'memory:'})['OUTPUT']
+
+    # Thiessen polygons with area + perimeter, clipped to the tract and split into singleparts
+
+    voronoi = processing.run(
+        "qgis:voronoipolygons",
+        {'INPUT':joined,
+         'BUFFER':constants['buffer'],
+         'OUTPUT':'memory:'})['OUTPUT']
+
+    voronoi = processing.run(
+        "qgis:exportaddgeometrycolumns",
+        {'INPUT':voronoi,
+         'CALC_METHOD':0,
+         'OUTPUT':'memory:'})['OUTPUT']
+
+    voronoi = processing.run(
+        "native:clip",
+        {'INPUT':voronoi,
+         'OVERLAY':tract,
+         'OUTPUT':'memory:'})['OUTPUT']
+
+    voronoi = processing.run(
+        "native:multiparttosingleparts",
+        {'INPUT':voronoi,
+         'OUTPUT':'memory:'})['OUTPUT']
+
+    # Intersect farmland with Thiessens and aggregate farmland area by dzong
+
+    farmland = processing.run(
+        "native:intersection",
+        {'INPUT':farm_clip,
+         'OVERLAY':voronoi,
+         'INPUT_FIELDS':[],
+         'OVERLAY_FIELDS':['dzong','ecoregion'],
+         'OVERLAY_FIELDS_PREFIX':'',
+         'OUTPUT':'memory:'})['OUTPUT']
+
+    farmland = processing.run(
+        "qgis:exportaddgeometrycolumns",
+        {'INPUT':farmland,
+        'CALC_METHOD':0,
+        'OUTPUT':'memory:'})['OUTPUT']
+
+    farm_agg = processing.run(
+        "qgis:aggregate", {
+        'INPUT':farmland,
+        'GROUP_BY':'\"dzong\"',
+        'AGGREGATES':[
+        {'aggregate': 'first_value', 'delimiter': ',', 'input': '"ecoregion"', 'length': 254, 'name': 'ecoregion', 'precision': 0, 'type': 10},
+        {'aggregate': 'sum', 'delimiter': ',', 'input': '"area"', 'length': 23, 'name': 'area', 'precision': 15, 'type': 6},
+        {'aggregate': 'first_value', 'delimiter': ',', 'input': '"dzong"', 'length': 254, 'name': 'dzong_2', 'precision': 0, 'type': 10}],
+        'OUTPUT':'memory:'})['OUTPUT']
+
+    add_fields(farm_agg, ['farm_km'], lambda f: [divide(value(f, 'area'), 1000000)])
+
+    thiessen = processing.run(
+        "native:joinattributestable",
+        {'INPUT':voronoi,
+         'FIELD':'dzong',
+         'INPUT_2':farm_agg,
+         'FIELD_2':'dzong_2',
+         'FIELDS_TO_COPY':['farm_km'],
+         'METHOD':1,
+         'DISCARD_NONMATCHING':False,
+         'PREFIX':'',
+         'OUTPUT':'memory:'})['OUTPUT']
+
+    # Hectares, barley yields, population estimates, clerical ratios and density in one pass
+
+    def calculate(f):
+        farm_hec = multiply(value(f, 'farm_km'), 100)
+        barhec = multiply(farm_hec, constants['barley_share'])
+        barley_low = multiply(barhec, constants['yield_low'])
+        barley_high = multiply(barhec, constants['yield_high'])
+        barley_avg = multiply(barhec, constants['yield_avg'])
+        pop_low = divide(barley_low, constants['consumption'])
+        pop_high = divide(barley_high, constants['consumption'])
+        pop_avg = divide(barley_avg, constants['consumption'])
+        return [farm_hec, barhec, barley_low, barley_high, barley_avg, pop_low, pop_high, pop_avg,
+                divide(value(f, 'monks'), pop_avg), divide(value(f, 'nuns'), pop_avg),
+                divide(pop_avg, divide(value(f, 'area'), 1000000))]
+
+    add_fields(thiessen, ['farm_hec','barhec','barley_low','barley_high','barley_avg','pop_low','pop_high',
+                          'pop_avg','Mratio_avg','Fratio_avg','pop_dens'], calculate)
+
+    # Totals as reported at the end of qgis_calculation.py
+
+    features = list(thiessen.getFeatures())
+    result = {'ok': True}
+    for name in ['pop_low','pop_high','pop_avg','farm_hec']:
+        result[name] = sum(filter(None, [value(f, name) for f in features]))
+    result['barley_hec'] = result['farm_hec'] * constants['barley_share']
+
+    # Adding 1990 population centroids and writing out final thiessen shapefile and data as csv (only if asked)
+
+    if 'output' in job:
+        final = processing.run(
+            "qgis:joinbylocationsummary",
+            {'INPUT':thiessen,
+            'JOIN':pop_1990,
+            'PREDICATE':[1],
+            'JOIN_FIELDS':['total_pop_'],
+            'SUMMARIES':[5],
+            'DISCARD_NONMATCHING':False,
+            'OUTPUT':'memory:'})['OUTPUT']
+
+        add_fields(final, ['change'], lambda f: [divide(value(f, 'total_pop__sum'), value(f, 'pop_avg'))])
+
+        os.makedirs(job['output'], exist_ok=True)
+        output = os.path.join(job['output'], 'thiessen_final.shp')
+        QgsVectorFileWriter.writeAsVectorFormat(final,output,"UTF-8",final.crs(),"ESRI Shapefile")
+        output = os.path.join(job['output'], 'thiessen_final.csv')
+        QgsVectorFileWriter.writeAsVectorFormat(final,output,"UTF-8",final.crs(),"CSV")
+        result['output'] = job['output']
+
+    return result
+
+##############################
+## 5 ## Serve scenario jobs ##
+##############################
+
+# Each connection is read on its own thread so an idle analyst never blocks the others, while jobs are passed
+# through a queue and run one at a time on the main thread (processing and the cached layers are not thread safe).
+# Each connection may send several jobs.
+
+jobs = queue.Queue()
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            reply = queue.Queue(maxsize=1)
+            jobs.put((line, reply))
+            self.wfile.write((json.dumps(reply.get()) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+class JobServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+server = JobServer((host, port), JobHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+print('Worker ready on ' + host + ':' + str(port))
+try:
+    while True:
+        line, reply = jobs.get()
+        try:
+            result = run_scenario(json.loads(line))
+        except Exception as e:
+            result = {'ok': False, 'error': str(e)}
+        reply.put(result)
+except KeyboardInterrupt:
+    pass
+finally:
+    server.shutdown()
+    server.server_close()
+    qgs.exitQgis()